@@ -4,6 +4,9 @@ import os
 import sys
 import json
 import csv
+import itertools
+import mmap
+import re
 import struct
 import xml.etree.ElementTree as ET
 
@@ -25,9 +28,19 @@ input and output types are determined from file extensions and may be any of;
 
 class BinaryFormat:
 
+    # Data is split into four streams; a bit stream of types and flags, a byte stream of variable
+    # length integers, an array of 64 bit reals and a byte stream of blobs such as strings. The lengths
+    # of the bit and integer streams and the number of reals are stored as integers at the start of
+    # the data, followed by the four streams.
+
+    # Data starts with a magic number and format version, ahead of the stream lengths
+    MAGIC = b'BFMT'
+    VERSION = 1
+
     # Data types are stored in a variable length bit field
     TYPE_BIT_LENGTH = 3
     TYPE_BIT_STEP = 0
+    TYPE_FIRST_CHUNK_MAX = 2**TYPE_BIT_LENGTH - 1
 
     TYPE_EMPTY = 0x00
     TYPE_BOOL = 0x01
@@ -44,85 +57,81 @@ class BinaryFormat:
 
 class BinaryWriter:
     def __init__(self):
-        self.data = bytearray()
+        self.data = None
+        self.words = []
         self.bits = 0
-        self.bit_shift = 0
-        self.bit_write_position = None
+        self.bit_count = 0
         self.string_map = {}
         self.string_list = []
-
-    def write_byte(self, value):
-        self.data.append(value)
+        self.integers = bytearray()
+        self.reals = []
+        self.blobs = []
 
     def write_bytes(self, data):
-        self.data += data
+        self.blobs.append(data)
 
     def write_bit(self, value):
-        self.write_bits(1, value)
+        # Single bits are the most frequent write so the accumulator is updated without a further call
+        self.bits |= value << self.bit_count
+        self.bit_count += 1
+        if self.bit_count >= 64:
+            self.flush_bits()
 
     def write_bits(self, num_bits, value):
-        for i in range(num_bits//8):
-            self.data.append(value & 0xff)
-            value >>= 8
-
-        num_bits = num_bits & 0x07
-        if num_bits > 0:
-            self.bits |= value << self.bit_shift
-
-            if self.bit_shift == 0:
-                self.bit_write_position = len(self.data)
-                self.data.append(0)
-                self.bit_shift = num_bits
-            elif (self.bit_shift + num_bits) > 7:
-                self.data[self.bit_write_position] = self.bits & 0xff
-                self.bits >>= 8
-                self.bit_shift = self.bit_shift + num_bits - 8
-                if self.bit_shift > 0:
-                    self.bit_write_position = len(self.data)
-                    self.data.append(0)
-            else:
-                self.bit_shift += num_bits
+        # Bits accumulate in an integer and are only moved to the output as whole 64 bit words
+        self.bits |= value << self.bit_count
+        self.bit_count += num_bits
+        if self.bit_count >= 64:
+            self.flush_bits()
+
+    def flush_bits(self):
+        # Move all complete 64 bit words from the bit accumulator to the output
+        num_words = self.bit_count >> 6
+        num_bits = num_words * 64
+        if num_words == 1:
+            self.words.append(self.bits & 0xffffffffffffffff)
+        else:
+            word_bytes = (self.bits & ((1 << num_bits) - 1)).to_bytes(num_words * 8, 'little')
+            self.words.extend(struct.unpack('<{0}Q'.format(num_words), word_bytes))
+        self.bits >>= num_bits
+        self.bit_count -= num_bits
 
     def write_integer(self, value):
-        # Integers are stored in a variable length format
-        while True:
-            if value < 256:
-                self.write_bits(2, 0)
-                self.write_byte(value)
-                break
-            elif value < 256*256:
-                self.write_bits(2, 1)
-                self.write_byte(value & 0xff)
-                self.write_byte(value >> 8)
-                break
-            elif value < 256*256*256:
-                self.write_bits(2, 2)
-                self.write_byte(value & 0xff)
-                self.write_byte((value >> 8) & 0xff)
-                self.write_byte(value >> 16)
-                break
-            else:
-                self.write_bits(2, 3)
-                self.write_byte(value & 0xff)
-                self.write_byte((value >> 8) & 0xff)
-                self.write_byte((value >> 16) & 0xff)
-                value >>= 24
+        # Integers are stored in a prefix variable length format; the number of trailing zero bits
+        # in the first byte gives the total number of bytes, leaving 7 bits of value per byte
+        if value < 0x80:
+            self.integers.append((value << 1) | 1)
+            return
+        num_bytes = (value.bit_length() + 6) // 7
+        if num_bytes <= 8:
+            self.integers += ((value << num_bytes) | (1 << (num_bytes - 1))).to_bytes(num_bytes, 'little')
+        else:
+            # Larger values are stored as a zero byte followed by their length and bytes
+            num_bytes = (value.bit_length() + 7) >> 3
+            self.integers.append(0)
+            self.write_integer(num_bytes)
+            self.integers += value.to_bytes(num_bytes, 'little')
+
+    def write_signed_integer(self, value):
+        # Signed integers are zigzag encoded so the sign is held in the lowest bit;
+        # shifting by the bit length yields -1 for negative values and 0 otherwise
+        self.write_integer((value << 1) ^ (value >> value.bit_length()))
 
     def write_ieee754_2_64(self, value):
-        value = struct.pack('<d', value)
-        self.write_bytes(value)
+        # Reals are collected and packed together in finalize
+        self.reals.append(value)
 
     def write_string(self, string):
-        if string in self.string_map:
+        index = self.string_map.get(string)
+        if index is not None:
             self.write_bit(1)                            # 1 = indexed string
-            index = self.string_map[string]
             self.write_integer(index)
         else:
             self.write_bit(0)                            # 0 = literal string
             self.string_map[string] = len(self.string_map)
             string_bytes = string.encode('utf-8')
             self.write_integer(len(string_bytes))
-            self.write_bytes(string_bytes)
+            self.blobs.append(string_bytes)
 
     def write_variable_bits(self, bit_length, bit_step, value):
         max_value = 2**bit_length - 1
@@ -135,14 +144,47 @@ class BinaryWriter:
         self.write_bits(bit_length, value)
 
     def write_type(self, value):
-        self.write_variable_bits(BinaryFormat.TYPE_BIT_LENGTH, BinaryFormat.TYPE_BIT_STEP, value)
+        # Most types fit in the first chunk of the bit field so are written with a single call
+        if value < BinaryFormat.TYPE_FIRST_CHUNK_MAX:
+            self.write_bits(BinaryFormat.TYPE_BIT_LENGTH, value)
+        else:
+            self.write_variable_bits(BinaryFormat.TYPE_BIT_LENGTH, BinaryFormat.TYPE_BIT_STEP, value)
+
+    def append_stream(self, writer):
+        # Append the streams of another writer; this writer must not have written any strings
+        # since string indices in the appended stream are relative to the other writer's string map
+        if self.string_map:
+            raise ValueError('Cannot append a stream after strings have been written')
+        words = struct.pack('<{0}Q'.format(len(writer.words)), *writer.words)
+        self.write_bits(len(words) * 8, int.from_bytes(words, 'little'))
+        self.write_bits(writer.bit_count, writer.bits)
+        self.integers += writer.integers
+        self.reals += writer.reals
+        self.blobs += writer.blobs
+        self.string_map = writer.string_map
+
+    def pack_bits(self):
+        # Return all words followed by any remaining bits
+        tail = self.bits.to_bytes((self.bit_count + 7) >> 3, 'little')
+        packed = struct.pack('<{0}Q'.format(len(self.words)), *self.words) + tail
+        self.words = []
+        self.bits = 0
+        self.bit_count = 0
+        return packed
 
     def finalize(self):
-        # write any remaining bits
-        if self.bit_shift > 0:
-            self.data[self.bit_write_position] = self.bits & 0xff
-            self.bits = 0
-            self.bit_shift = 0
+        # Write the stream lengths followed by the streams
+        stream = self.pack_bits()
+        header = BinaryWriter()
+        header.write_integer(BinaryFormat.VERSION)
+        header.write_integer(len(stream))
+        header.write_integer(len(self.integers))
+        header.write_integer(len(self.reals))
+        reals = struct.pack('<{0}d'.format(len(self.reals)), *self.reals)
+        self.data = b''.join([BinaryFormat.MAGIC, header.integers, stream, self.integers, reals] + self.blobs)
+        self.integers = bytearray()
+        self.reals = []
+        self.blobs = []
 
 
 class BinaryReader:
@@ -150,68 +192,91 @@ class BinaryReader:
         self.data = None
         self.position = 0
         self.bits = 0
-        self.bit_shift = 0
+        self.bit_count = 0
         self.string_map = {}
         self.string_list = []
+        self.integer_position = 0
+        self.reals = ()
+        self.real_index = 0
+        self.blob_position = 0
 
-    def read_byte(self):
-        value = self.data[self.position]
-        self.position += 1
-        return value
+    def load(self, binary_data):
+        # Check the magic number and version, then position each stream from the lengths that follow
+        self.data = binary_data
+        magic_length = len(BinaryFormat.MAGIC)
+        if len(binary_data) <= magic_length or binary_data[:magic_length] != BinaryFormat.MAGIC:
+            raise ValueError('Unsupported binary format')
+        self.integer_position = magic_length
+        if self.read_integer() != BinaryFormat.VERSION:
+            raise ValueError('Unsupported binary format')
+        stream_length = self.read_integer()
+        integers_length = self.read_integer()
+        num_reals = self.read_integer()
+        self.position = self.integer_position
+        self.integer_position += stream_length
+        reals_position = self.integer_position + integers_length
+        self.reals = struct.unpack_from('<{0}d'.format(num_reals), self.data, reals_position)
+        self.blob_position = reals_position + num_reals * 8
 
     def read_bytes(self, length):
-        value = self.data[self.position:self.position + length]
-        self.position += length
+        value = self.data[self.blob_position:self.blob_position + length]
+        self.blob_position += length
         return value
 
     def read_bit(self):
-        return self.read_bits(1)
+        # Single bits are the most frequent read so the buffer is consumed without a further call
+        if self.bit_count == 0:
+            self.refill_bits(1)
+        value = self.bits & 0x01
+        self.bits >>= 1
+        self.bit_count -= 1
+        return value
 
     def read_bits(self, num_bits):
-        value = 0
-        num_bytes = num_bits // 8
-        for i in range(num_bytes):
-            value = value + (self.data[self.position] << (i*8))
-            self.position += 1
-
-        num_bits &= 0x07
-        if num_bits > 0:
-            if self.bit_shift == 0:
-                self.bits = self.read_byte()
-            elif self.bit_shift + num_bits > 8:
-                self.bits += self.read_byte() << 8
-            mask = (2**num_bits) - 1
-            bit_value = (self.bits >> self.bit_shift) & mask
-            self.bit_shift += num_bits
-            if self.bit_shift >= 8:
-                self.bits >>= 8
-                self.bit_shift -= 8
-            return value + (bit_value << (num_bytes*8))
+        if self.bit_count < num_bits:
+            self.refill_bits(num_bits)
+        value = self.bits & ((1 << num_bits) - 1)
+        self.bits >>= num_bits
+        self.bit_count -= num_bits
+        return value
+
+    def refill_bits(self, num_bits):
+        # Top up the bit buffer to at least num_bits, loading a whole 64 bit word where possible
+        num_bytes = (num_bits - self.bit_count + 7) >> 3
+        if num_bytes <= 8 and self.position + 8 <= len(self.data):
+            self.bits |= struct.unpack_from('<Q', self.data, self.position)[0] << self.bit_count
+            num_bytes = 8
         else:
-            return value
+            chunk = self.data[self.position:self.position + num_bytes]
+            if len(chunk) < num_bytes:
+                raise ValueError('Unexpected end of data')
+            self.bits |= int.from_bytes(chunk, 'little') << self.bit_count
+        self.position += num_bytes
+        self.bit_count += num_bytes * 8
 
     def read_integer(self):
-        value = 0
-        shift = 0
-        while True:
-            length = self.read_bits(2)
-            if length == 0:
-                value += self.read_byte() << shift
-                break
-            elif length == 1:
-                value += (self.read_byte() << shift) + (self.read_byte() << (shift+8))
-                break
-            elif length == 2:
-                value += (self.read_byte() << shift) + (self.read_byte() << (shift+8)) + (self.read_byte() << (shift+16))
-                break
-            else:
-                value += (self.read_byte() << shift) + (self.read_byte() << (shift+8)) + (self.read_byte() << (shift+16))
-                shift += 24
-        return value
+        position = self.integer_position
+        prefix = self.data[position]
+        if prefix & 0x01:
+            self.integer_position = position + 1
+            return prefix >> 1
+        if prefix == 0:
+            self.integer_position = position + 1
+            num_bytes = self.read_integer()
+            position = self.integer_position
+            self.integer_position = position + num_bytes
+            return int.from_bytes(self.data[position:position + num_bytes], 'little')
+        num_bytes = (prefix & -prefix).bit_length()
+        self.integer_position = position + num_bytes
+        return int.from_bytes(self.data[position:position + num_bytes], 'little') >> num_bytes
+
+    def read_signed_integer(self):
+        value = self.read_integer()
+        return (value >> 1) ^ -(value & 1)
 
     def read_ieee754_2_64(self):
-        value = struct.unpack('<d', self.data[self.position:self.position+8])[0]
-        self.position += 8
+        value = self.reals[self.real_index]
+        self.real_index += 1
         return value
 
     def read_string(self):
@@ -222,6 +287,9 @@ class BinaryReader:
         else:
             length = self.read_integer()
             string = self.read_bytes(length).decode('utf-8')
+            if length <= 32:
+                # Short strings are typically keys and tags so share them with any equal interned strings
+                string = sys.intern(string)
             self.string_list.append(string)
             return string
 
@@ -239,12 +307,32 @@ class BinaryReader:
         return value
 
     def read_type(self):
-        return self.read_variable_bits(BinaryFormat.TYPE_BIT_LENGTH, BinaryFormat.TYPE_BIT_STEP)
+        # Read the first chunk directly from the buffer since types are read for every field
+        if self.bit_count < BinaryFormat.TYPE_BIT_LENGTH:
+            self.refill_bits(BinaryFormat.TYPE_BIT_LENGTH)
+        value = self.bits & BinaryFormat.TYPE_FIRST_CHUNK_MAX
+        self.bits >>= BinaryFormat.TYPE_BIT_LENGTH
+        self.bit_count -= BinaryFormat.TYPE_BIT_LENGTH
+        if value < BinaryFormat.TYPE_FIRST_CHUNK_MAX:
+            return value
+        return value + self.read_variable_bits(BinaryFormat.TYPE_BIT_LENGTH + BinaryFormat.TYPE_BIT_STEP,
+                                               BinaryFormat.TYPE_BIT_STEP)
 
 
 class JSONEncoder(BinaryWriter):
     def __init__(self):
         BinaryWriter.__init__(self)
+        # Fields are encoded by looking up their exact type rather than testing each type in turn
+        self.field_encoders = {
+            type(None): self.encode_empty,
+            bool: self.encode_bool,
+            int: self.encode_integer,
+            float: self.encode_real,
+            bytes: self.encode_bytes,
+            str: self.encode_utf8,
+            list: self.encode_list,
+            dict: self.encode_map,
+        }
 
     @staticmethod
     def _json_parse_float(value):
@@ -260,113 +348,179 @@ class JSONEncoder(BinaryWriter):
             return self.data
 
     def encode_field(self, value):
-        if value is None:
-            self.write_type(BinaryFormat.TYPE_EMPTY)
-        elif isinstance(value, bool):
-            self.write_type(BinaryFormat.TYPE_BOOL)
-            self.write_bit(0 if value is False else 1)
-        elif isinstance(value, int):
-            self.write_type(BinaryFormat.TYPE_INTEGER)
-            self.write_bit(0 if value >= 0 else 1)       # 0 if positive, 1 if negative
-            self.write_integer(abs(value))
-        elif isinstance(value, float):
-            self.write_type(BinaryFormat.TYPE_REAL)
-            self.write_ieee754_2_64(value)
-        elif isinstance(value, bytes):
-            self.write_type(BinaryFormat.TYPE_BYTES)
-            self.write_integer(len(value))
-            self.write_bytes(value)
-        elif isinstance(value, str):
-            self.write_type(BinaryFormat.TYPE_UTF8)
-            self.write_string(value)
-        elif isinstance(value, list):
-            self.write_type(BinaryFormat.TYPE_LIST)
-            self.write_integer(len(value))
-            for child in value:
-                self.encode_field(child)
-        elif isinstance(value, dict):
-            self.write_type(BinaryFormat.TYPE_MAP)
-            self.write_integer(len(value))
-            for child_key in value:
-                self.encode_field(child_key)
-                self.encode_field(value[child_key])
-        else:
-            raise ValueError('{0} type is unhandled'.format(type(value)))
+        # Fields are encoded from an explicit stack rather than recursively so nesting depth is unlimited;
+        # container encoders return an iterator over their children which is pushed on the stack, while
+        # all other fields are encoded as they are reached
+        field_encoders = self.field_encoders
+        stack = [iter((value,))]
+        while stack:
+            for value in stack[-1]:
+                encoder = field_encoders.get(type(value))
+                if encoder is None:
+                    raise ValueError('{0} type is unhandled'.format(type(value)))
+                children = encoder(value)
+                if children is not None:
+                    stack.append(children)
+                    break
+            else:
+                stack.pop()
+
+    def encode_empty(self, value):
+        self.write_type(BinaryFormat.TYPE_EMPTY)
+
+    def encode_bool(self, value):
+        self.write_type(BinaryFormat.TYPE_BOOL)
+        self.write_bit(0 if value is False else 1)
+
+    def encode_integer(self, value):
+        self.write_type(BinaryFormat.TYPE_INTEGER)
+        self.write_signed_integer(value)
+
+    def encode_real(self, value):
+        self.write_type(BinaryFormat.TYPE_REAL)
+        self.write_ieee754_2_64(value)
+
+    def encode_bytes(self, value):
+        self.write_type(BinaryFormat.TYPE_BYTES)
+        self.write_integer(len(value))
+        self.write_bytes(value)
+
+    def encode_utf8(self, value):
+        self.write_type(BinaryFormat.TYPE_UTF8)
+        self.write_string(value)
+
+    def encode_list(self, value):
+        self.write_type(BinaryFormat.TYPE_LIST)
+        self.write_integer(len(value))
+        return iter(value)
+
+    def encode_map(self, value):
+        self.write_type(BinaryFormat.TYPE_MAP)
+        self.write_integer(len(value))
+        return itertools.chain.from_iterable(value.items())
 
 
 class JSONDecoder(BinaryReader):
     def __init__(self):
         BinaryReader.__init__(self)
+        # Primitive fields are decoded by looking up their type; container types are absent
+        self.primitive_decoders = {
+            BinaryFormat.TYPE_EMPTY: self.decode_empty,
+            BinaryFormat.TYPE_BOOL: self.decode_bool,
+            BinaryFormat.TYPE_INTEGER: self.read_signed_integer,
+            BinaryFormat.TYPE_REAL: self.read_ieee754_2_64,
+            BinaryFormat.TYPE_BYTES: self.decode_bytes,
+            BinaryFormat.TYPE_UTF8: self.read_string,
+            BinaryFormat.TYPE_COMMENT: self.decode_comment,
+        }
 
     def decode(self, binary_data):
-        self.data = binary_data
+        self.load(binary_data)
         return self.decode_field()
 
     def decode_field(self, field_type=None):
-        if not field_type:
-            field_type = self.read_type()
+        # Containers are filled from an explicit stack rather than recursively; each frame holds the
+        # container, its number of items, the item type of a uniform list and the next item index.
+        # The field itself is decoded as the single item of a root list.
+        root = [None]
+        stack = [[root, 1, field_type, 0]]
+        read_type = self.read_type
+        primitive_decoders = self.primitive_decoders
+        type_properties = BinaryFormat.TYPE_PROPERTIES
+        while stack:
+            frame = stack[-1]
+            container, num_items, item_type, index = frame
+            child_frame = None
+            if isinstance(container, list):
+                # Lists are allocated at their final size so items are assigned by index
+                while index < num_items:
+                    field_type = read_type() if item_type is None else item_type
+                    if field_type == type_properties:
+                        field_type = self.skip_properties()
+                    decoder = primitive_decoders.get(field_type)
+                    if decoder is None:
+                        child_frame = self.decode_container(field_type)
+                        container[index] = child_frame[0]
+                        index += 1
+                        break
+                    container[index] = decoder()
+                    index += 1
+            else:
+                while index < num_items:
+                    index += 1
+                    field_type = read_type()
+                    if field_type == type_properties:
+                        field_type = self.skip_properties()
+                    decoder = primitive_decoders.get(field_type)
+                    if decoder is None:
+                        raise ValueError('Unexpected key type')
+                    key = decoder()
+                    if not key:
+                        continue
 
-        # JSON does not support properties
+                    field_type = read_type()
+                    if field_type == type_properties:
+                        field_type = self.skip_properties()
+                    decoder = primitive_decoders.get(field_type)
+                    if decoder is None:
+                        child_frame = self.decode_container(field_type)
+                        value = child_frame[0]
+                    else:
+                        value = decoder()
+                    if key in container:
+                        if not isinstance(container[key], list):
+                            container[key] = [container[key]]
+                        container[key].append(value)
+                    else:
+                        container[key] = value
+                    if child_frame is not None:
+                        break
+            if child_frame is None:
+                stack.pop()
+            else:
+                frame[3] = index
+                stack.append(child_frame)
+        return root[0]
+
+    def decode_container(self, field_type):
+        # Returns a stack frame for an empty container; lists are allocated at their final size
+        if field_type == BinaryFormat.TYPE_LIST:
+            num_values = self.read_integer()
+            return [[None] * num_values, num_values, None, 0]
+        elif field_type == BinaryFormat.TYPE_UNIFORM_LIST:
+            item_type = self.read_type()
+            num_values = self.read_integer()
+            return [[None] * num_values, num_values, item_type, 0]
+        elif field_type == BinaryFormat.TYPE_MAP:
+            num_items = self.read_integer()
+            return [{}, num_items, None, 0]
+        else:
+            raise ValueError('Unexpected data type')
+
+    def skip_properties(self):
+        # JSON does not support properties; skip them and return the type of the field that follows
+        field_type = BinaryFormat.TYPE_PROPERTIES
         while field_type == BinaryFormat.TYPE_PROPERTIES:
             num_items = self.read_integer()
             for i in range(num_items):
                 key = self.decode_field()
                 value = self.decode_field()
             field_type = self.read_type()
+        return field_type
 
-        # Decode primitive types
-        if field_type == BinaryFormat.TYPE_EMPTY:
-            return None
-        elif field_type == BinaryFormat.TYPE_BOOL:
-            return self.read_bit() == 1
-        elif field_type == BinaryFormat.TYPE_INTEGER:
-            is_negative = self.read_bit() == 1
-            value = self.read_integer()
-            return -value if is_negative else value
-        elif field_type == BinaryFormat.TYPE_REAL:
-            return self.read_ieee754_2_64()
-        elif field_type == BinaryFormat.TYPE_BYTES:
-            length = self.read_integer()
-            return self.read_bytes(length)
-        elif field_type == BinaryFormat.TYPE_UTF8:
-            return self.read_string()
-        elif field_type == BinaryFormat.TYPE_COMMENT:
-            self.read_string()      # JSON does not support comments
-            return None
+    def decode_empty(self):
+        return None
 
-        # Decode container types
-        elif field_type == BinaryFormat.TYPE_LIST:
-            values = []
-            num_values = self.read_integer()
-            for i in range(num_values):
-                values.append(self.decode_field())
-            return values
+    def decode_bool(self):
+        return self.read_bit() == 1
 
-        elif field_type == BinaryFormat.TYPE_UNIFORM_LIST:
-            values = []
-            field_type = self.read_type()
-            num_values = self.read_integer()
-            for i in range(num_values):
-                values.append(self.decode_field(field_type))
-            return values
+    def decode_bytes(self):
+        length = self.read_integer()
+        return self.read_bytes(length)
 
-        elif field_type == BinaryFormat.TYPE_MAP:
-            item_map = {}
-            num_items = self.read_integer()
-            for i in range(num_items):
-                key = self.decode_field()
-                if key:
-                    value = self.decode_field()
-                    if key in item_map:
-                        if not isinstance(item_map[key], list):
-                            item_map[key] = [item_map[key]]
-                        item_map[key].append(value)
-                    else:
-                        item_map[key] = value
-            return item_map
-
-        else:
-            raise ValueError('Unexpected data type')
+    def decode_comment(self):
+        self.read_string()      # JSON does not support comments
+        return None
 
 
 class XMLCustomTreeBuilder(ET.TreeBuilder):
@@ -391,41 +545,44 @@ class XMLEncoder(BinaryWriter):
         self.finalize()
         return self.data
 
-    def encode_node(self, node):
-        if node.tag == ET.Comment:
-            self.write_type(BinaryFormat.TYPE_COMMENT)
-            self.write_string(node.text)
-        else:
-            # Write node tag as the item key
-            self.write_type(BinaryFormat.TYPE_UTF8)
-            self.write_string(node.tag)
-
-            # Write node attributes
-            if node.attrib:
-                self.write_type(BinaryFormat.TYPE_PROPERTIES)
-                self.write_integer(len(node.attrib))
-                for attribute_key in node.attrib:
-                    self.write_type(BinaryFormat.TYPE_UTF8)
-                    self.write_string(attribute_key)
-                    self.write_type(BinaryFormat.TYPE_UTF8)
-                    self.write_string(node.attrib[attribute_key])
-
-            # Write node contents; note, if the node contains children then the node text is ignored
-            if len(node):
-                self.write_type(BinaryFormat.TYPE_MAP)
-                self.write_integer(len(node))
-                for child in node:
-                    self.encode_node(child)
-            elif node.text:
-                # Ignore node text if it's only whitespace
-                text = node.text.strip()
-                if text != '':
-                    self.write_type(BinaryFormat.TYPE_UTF8)
-                    self.write_string(text)
+    def encode_node(self, root_node):
+        # Nodes are encoded from an explicit stack rather than recursively so nesting depth is unlimited
+        stack = [root_node]
+        while stack:
+            node = stack.pop()
+            if node.tag == ET.Comment:
+                self.write_type(BinaryFormat.TYPE_COMMENT)
+                self.write_string(node.text)
+            else:
+                # Write node tag as the item key
+                self.write_type(BinaryFormat.TYPE_UTF8)
+                self.write_string(node.tag)
+
+                # Write node attributes
+                if node.attrib:
+                    self.write_type(BinaryFormat.TYPE_PROPERTIES)
+                    self.write_integer(len(node.attrib))
+                    for attribute_key in node.attrib:
+                        self.write_type(BinaryFormat.TYPE_UTF8)
+                        self.write_string(attribute_key)
+                        self.write_type(BinaryFormat.TYPE_UTF8)
+                        self.write_string(node.attrib[attribute_key])
+
+                # Write node contents; note, if the node contains children then the node text is ignored
+                if len(node):
+                    self.write_type(BinaryFormat.TYPE_MAP)
+                    self.write_integer(len(node))
+                    stack.extend(reversed(node))
+                elif node.text:
+                    # Ignore node text if it's only whitespace
+                    text = node.text.strip()
+                    if text != '':
+                        self.write_type(BinaryFormat.TYPE_UTF8)
+                        self.write_string(text)
+                    else:
+                        self.write_type(BinaryFormat.TYPE_EMPTY)
                 else:
                     self.write_type(BinaryFormat.TYPE_EMPTY)
-            else:
-                self.write_type(BinaryFormat.TYPE_EMPTY)
 
 
 class XMLDecoder(BinaryReader):
@@ -433,7 +590,7 @@ class XMLDecoder(BinaryReader):
         BinaryReader.__init__(self)
 
     def decode(self, binary_data):
-        self.data = binary_data
+        self.load(binary_data)
         root_node = ET.Element('root')
         self.decode_node(root_node)
         return root_node[0]
@@ -495,9 +652,7 @@ class XMLDecoder(BinaryReader):
         elif field_type == BinaryFormat.TYPE_BOOL:
             return self.read_bit() == 1
         elif field_type == BinaryFormat.TYPE_INTEGER:
-            is_negative = self.read_bit() == 1
-            value = self.read_integer()
-            return -value if is_negative else value
+            return self.read_signed_integer()
         elif field_type == BinaryFormat.TYPE_REAL:
             return self.read_ieee754_2_64()
         elif field_type == BinaryFormat.TYPE_BYTES:
@@ -510,48 +665,54 @@ class XMLDecoder(BinaryReader):
 
 
 class CSVEncoder(BinaryWriter):
+    # Numeric values are recognised by pattern so that strings don't pay for a failed conversion
+    # int() and float() strip whitespace but not the ASCII separator characters \x1c-\x1f, which \s matches
+    INTEGER_PATTERN = re.compile(r'[^\S\x1c-\x1f]*[-+]?\d+[^\S\x1c-\x1f]*')
+    REAL_PATTERN = re.compile(r'[^\S\x1c-\x1f]*[-+]?(\d+\.?\d*([eE][-+]?\d+)?|\.\d+([eE][-+]?\d+)?|inf|infinity|nan)'
+                              r'[^\S\x1c-\x1f]*', re.IGNORECASE)
+
     def __init__(self):
         BinaryWriter.__init__(self)
 
     def encode(self, input_path):
-        # The top level container is a list of lists
+        # The top level container is a list of lists; rows are encoded to a separate writer in a
+        # single pass over the file so the row count is known before the container is written
+        rows = BinaryWriter()
         num_rows = 0
+        integer_match = CSVEncoder.INTEGER_PATTERN.fullmatch
+        real_match = CSVEncoder.REAL_PATTERN.fullmatch
         with open(input_path, 'r', newline='') as f:
             for row in csv.reader(f):
                 num_rows += 1
-        self.write_type(BinaryFormat.TYPE_UNIFORM_LIST)
-        self.write_type(BinaryFormat.TYPE_LIST)
-        self.write_integer(num_rows)
-
-        # Now write each row as a list
-        with open(input_path, 'r', newline='') as f:
-            for row in csv.reader(f):
-                self.write_integer(len(row))
+                rows.write_integer(len(row))
                 for value in row:
                     if value.strip() == '':
-                        self.write_type(BinaryFormat.TYPE_EMPTY)
-                        continue
-
-                    try:
-                        int_value = int(value)
-                        self.write_type(BinaryFormat.TYPE_INTEGER)
-                        self.write_bit(0 if int_value >= 0 else 1)       # 0 if positive, 1 if negative
-                        self.write_integer(abs(int_value))
+                        rows.write_type(BinaryFormat.TYPE_EMPTY)
                         continue
-                    except ValueError:
-                        pass
 
-                    try:
-                        float_value = float(value)
-                        self.write_type(BinaryFormat.TYPE_REAL)
-                        self.write_ieee754_2_64(float_value)
-                        continue
-                    except ValueError:
-                        pass
+                    # Plain digit strings such as ids are recognised by a single scan before trying the pattern
+                    int_value = None
+                    if value.isdecimal() or integer_match(value):
+                        try:
+                            int_value = int(value)
+                        except ValueError:
+                            pass        # too many digits to convert, so fall through to a real or string
+
+                    if int_value is not None:
+                        rows.write_type(BinaryFormat.TYPE_INTEGER)
+                        rows.write_signed_integer(int_value)
+                    elif real_match(value):
+                        rows.write_type(BinaryFormat.TYPE_REAL)
+                        rows.write_ieee754_2_64(float(value))
+                    else:
+                        # Write as a string
+                        rows.write_type(BinaryFormat.TYPE_UTF8)
+                        rows.write_string(value)
 
-                    # Write as a string
-                    self.write_type(BinaryFormat.TYPE_UTF8)
-                    self.write_string(value)
+        self.write_type(BinaryFormat.TYPE_UNIFORM_LIST)
+        self.write_type(BinaryFormat.TYPE_LIST)
+        self.write_integer(num_rows)
+        self.append_stream(rows)
         self.finalize()
         return self.data
 
@@ -561,7 +722,7 @@ class CSVDecoder(BinaryReader):
         BinaryReader.__init__(self)
 
     def decode(self, binary_data):
-        self.data = binary_data
+        self.load(binary_data)
         return self.decode_field()
 
     def decode_field(self, field_type=None):
@@ -582,9 +743,7 @@ class CSVDecoder(BinaryReader):
         elif field_type == BinaryFormat.TYPE_BOOL:
             return self.read_bit() == 1
         elif field_type == BinaryFormat.TYPE_INTEGER:
-            is_negative = self.read_bit() == 1
-            value = self.read_integer()
-            return -value if is_negative else value
+            return self.read_signed_integer()
         elif field_type == BinaryFormat.TYPE_REAL:
             return self.read_ieee754_2_64()
         elif field_type == BinaryFormat.TYPE_BYTES:
@@ -598,23 +757,14 @@ class CSVDecoder(BinaryReader):
 
         # Decode container types
         elif field_type == BinaryFormat.TYPE_LIST:
-            output = ''
+            # Values are joined once rather than growing the output string with each value
             num_values = self.read_integer()
-            for i in range(num_values):
-                output += str(self.decode_field())
-                if i < num_values - 1:
-                    output += ','
-            return output
+            return ','.join([str(self.decode_field()) for i in range(num_values)])
 
         elif field_type == BinaryFormat.TYPE_UNIFORM_LIST:
-            output = ''
             field_type = self.read_type()
             num_values = self.read_integer()
-            for i in range(num_values):
-                output += str(self.decode_field(field_type))
-                if i < num_values - 1:
-                    output += '\n'
-            return output
+            return '\n'.join([str(self.decode_field(field_type)) for i in range(num_values)])
 
         elif field_type == BinaryFormat.TYPE_MAP:
             raise ValueError ('Map type is unsupported')
@@ -634,31 +784,40 @@ def interchange(input_path, output_path):
     elif input_type == 'csv':
         binary_data = CSVEncoder().encode(input_path)
     elif input_type == 'bf':
-        with open(input_path, 'rb') as f:
-            binary_data = f.read()
+        # Map the file rather than reading it so decoders slice directly from the mapped pages;
+        # empty files cannot be mapped
+        if os.path.getsize(input_path) == 0:
+            binary_data = b''
+        else:
+            with open(input_path, 'rb') as f:
+                binary_data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
     else:
         raise ValueError('Unknown input type')
 
-    # Encode binary to text
-    output_type = os.path.splitext(output_path)[1].lower().lstrip('.')
-    if output_type == 'json':
-        pyobject = JSONDecoder().decode(binary_data)
-        output_data = json.dumps(pyobject, indent=2)
-    elif output_type == 'xml':
-        xml_root = XMLDecoder().decode(binary_data)
-        ET.indent(xml_root)
-        output_data = ET.tostring(xml_root).decode('utf-8')
-    elif output_type == 'csv':
-        output_data = CSVDecoder().decode(binary_data)
-    elif output_type == 'bf':
-        output_data = binary_data
-    else:
-        raise ValueError('Unknown output type')
-
-    if output_data:
-        output_mode = 'wb' if output_type == 'bf' else 'w'
-        with open(output_path, output_mode) as f:
-            f.write(output_data)
+    try:
+        # Encode binary to text
+        output_type = os.path.splitext(output_path)[1].lower().lstrip('.')
+        if output_type == 'json':
+            pyobject = JSONDecoder().decode(binary_data)
+            output_data = json.dumps(pyobject, indent=2)
+        elif output_type == 'xml':
+            xml_root = XMLDecoder().decode(binary_data)
+            ET.indent(xml_root)
+            output_data = ET.tostring(xml_root).decode('utf-8')
+        elif output_type == 'csv':
+            output_data = CSVDecoder().decode(binary_data)
+        elif output_type == 'bf':
+            output_data = binary_data
+        else:
+            raise ValueError('Unknown output type')
+
+        if output_data:
+            output_mode = 'wb' if output_type == 'bf' else 'w'
+            with open(output_path, output_mode) as f:
+                f.write(output_data)
+    finally:
+        if isinstance(binary_data, mmap.mmap):
+            binary_data.close()
 
 
 if __name__ == '__main__':